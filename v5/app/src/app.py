@@ -1,12 +1,16 @@
-from contextlib import redirect_stdout
+from atexit import register as atexit_register
 from csv import writer as csv_writer, QUOTE_MINIMAL
+from functools import lru_cache
 from hashlib import sha256
-from json import load as json_load, dump as json_dump
-from os import getenv
+from json import load as json_load, dumps as json_dumps
+from os import (getenv, remove, open as os_open, write as os_write, close as os_close,
+                O_WRONLY, O_CREAT, O_TRUNC)
 from sys import argv as sys_argv
 from time import time
 
+from google.api_core.exceptions import GoogleAPIError
 from google.cloud import bigquery
+from requests.exceptions import RequestException
 
 iexec_root = '/'
 iexec_in = getenv('IEXEC_IN') or f'{iexec_root}iexec_in'
@@ -19,6 +23,10 @@ deterministic_file = 'result.txt'  # file used for deterministic comparison
 default_coins = ['BTC', 'ETH', 'DOGE', 'XRP', 'LTC', 'ADA', 'XMR', 'XLM', 'BNB', 'DOT']  # default if min user input
 max_input = 20  # max number of user input/coins
 min_input = 2  # min number of user input/coins
+page_size = 10000  # rows fetched per bigquery page
+csv_batch_size = 4096  # rows buffered per writerows call
+
+computed = {}  # written once to computed.json at the end of the run
 
 
 class ErrorCallback(Exception):
@@ -40,30 +48,46 @@ class ErrorCallback(Exception):
         return repr(self.msg)
 
 
+@lru_cache(maxsize=1)
+def get_log_file():
+    # opened once on first use so importing the module doesn't need iexec_out
+    # line buffered so every line is on disk if the TEE is killed mid run
+    f = open(f'{iexec_out}/log.txt', 'a', buffering=1)
+    atexit_register(f.close)
+    return f
+
+
 def stdout(t):
     # used for TEE log since regular stdout is not saved (use instead of print)
-    # adding try for sanity test (will try iexec_out first)
-    with open(f'{iexec_out}/log.txt', 'a') as f:
-        with redirect_stdout(f):
-            print(f'{t}')
+    get_log_file().write(f'{t}\n')
+
+
+def write_file(loc, data):
+    # small one-shot writes skip the buffered file object setup
+    data = memoryview(data.encode('utf-8'))
+
+    fd = os_open(loc, O_WRONLY | O_CREAT | O_TRUNC, 0o644)
+    try:
+        # os.write can write less than asked, keep going until everything is written
+        while data:
+            data = data[os_write(fd, data):]
+    finally:
+        os_close(fd)
 
 
 def create_receipt(t):
     # optional to generate receipt for records
-    with open(f'{iexec_out}/receipt.txt', 'w+') as f:
-        f.write(t)
+    write_file(f'{iexec_out}/receipt.txt', t)
 
 
 def create_error_file(e):
     # create an error file so results can be filtered
     # I guess no csv would indicate an error too
-    with open(f'{iexec_out}/ERROR.txt', 'w+') as f:
-        f.write(e)
+    write_file(f'{iexec_out}/ERROR.txt', e)
 
 
 def create_computed_json(c):
-    with open(f'{iexec_out}/computed.json', 'w+') as f:
-        json_dump(c, f, indent=2)
+    write_file(f'{iexec_out}/computed.json', json_dumps(c, indent=2))
 
 
 def create_deterministic(t):
@@ -72,70 +96,80 @@ def create_deterministic(t):
     sha = sha256(str(t).encode('utf-8')).hexdigest()
     deterministic_loc = f'{iexec_out}/{deterministic_file}'
 
-    with open(deterministic_loc, 'w+') as f:
-        f.write(sha)
-
-    computed = {"deterministic-output-path": deterministic_loc}
+    write_file(deterministic_loc, sha)
 
-    create_computed_json(computed)
+    computed["deterministic-output-path"] = deterministic_loc
 
     return True
 
 
-def create_csv(r):
-    cvs_data = {"header": ["coin", "price", "cap", "date"], "coins": {}}
-
-    for row in r:
-        # can filter results here or in JS
-        if row.cap != 0:
-            date_key = row.date.strftime('%Y-%m-%d')
-            # using date as key to filter out possible dupes
-            try:
-                # optional format here so it's easier to read in csv
-                formatted_price = row.price
-                formatted_cap = row.cap
+def remove_partial(loc):
+    # don't leave a half written output file behind on error
+    try:
+        remove(loc)
+    except OSError:
+        pass
 
-                cvs_data['coins'][row.coin][date_key] = [formatted_price, formatted_cap]
-            except KeyError:
-                # easier way to create dict per coin
-                cvs_data['coins'][row.coin] = {}
+
+def create_csv(r):
+    header = ["coin", "price", "cap", "date"]
+    csv_loc = f'{iexec_out}/data.csv'
 
     try:
-        with open(f'{iexec_out}/data.csv', 'w+', newline='') as csv_file:
+        with open(csv_loc, 'w', newline='', buffering=1 << 17) as csv_file:
             writer = csv_writer(csv_file, delimiter=',', quotechar='|', quoting=QUOTE_MINIMAL)
-            writer.writerow(cvs_data['header'])  # write header first (optional?)
-
-            for coin in cvs_data['coins']:
-                for coin_date in cvs_data['coins'][coin]:
-                    writer.writerow([coin,
-                                     cvs_data['coins'][coin][coin_date][0],
-                                     cvs_data['coins'][coin][coin_date][1],
-                                     coin_date])
+            writer.writerow(header)  # write header first (optional?)
+
+            # results are ordered by coin, date so rows can be written in one pass
+            # dupes of a coin/date are next to each other and the last one wins
+            pending = None
+            batch = []
+            for row in r:
+                # same as strftime('%Y-%m-%d') but formatted in C, for date or datetime
+                date_key = row.date.isoformat()[:10]
+
+                if pending is not None and (pending[0] != row.coin or pending[3] != date_key):
+                    batch.append(pending)
+                    if len(batch) >= csv_batch_size:
+                        writer.writerows(batch)
+                        batch.clear()
+
+                # optional format here so it's easier to read in csv
+                pending = (row.coin, row.price, row.cap, date_key)
+
+            if pending is not None:
+                batch.append(pending)
+            writer.writerows(batch)
+    except (GoogleAPIError, RequestException):
+        # pages are fetched while iterating, let the caller report it as a query error
+        remove_partial(csv_loc)
+        raise
     except Exception:
+        remove_partial(csv_loc)
         return False
 
     return True
 
 
+@lru_cache(maxsize=1)
+def get_client():
+    # credentials and connections are set up once and reused
+    # can set json location as env
+    return bigquery.Client.from_service_account_json(dataset_loc)
+
+
 def analyze_user_input(a):
     # takes user input then formats in a way that's readable for dapp logic
     # main purpose is to prevent exploits and user error
 
     dapp_input_valid = []
-    input_count = 0
+    add = dapp_input_valid.append
 
-    try:
-        dapp_input = a[1:]
-    except IndexError:
-        dapp_input = []
-
-    for arg in dapp_input:
-        if arg.isalnum():
-            if len(arg) < 6:
-                input_count += 1
-                if input_count > max_input:
-                    break
-                dapp_input_valid.append(arg.upper())
+    for arg in a[1:]:
+        if arg.isalnum() and len(arg) < 6:
+            add(arg.upper())
+            if len(dapp_input_valid) >= max_input:
+                break
 
     return dapp_input_valid
 
@@ -176,39 +210,46 @@ if __name__ == '__main__':
         while len(coins) < min_input:
             coins.add(default_coins.pop(0))
 
-        coins = sorted(list(coins))
-        coins_sql = ', '.join(f'"{c}"' for c in coins)
+        coins = sorted(coins)
 
         table = get_dataset_table(dataset_loc)
         if not table:
             raise ErrorCallback(1)
 
+        # coins are passed as a parameter so the sql text is the same every run
+        # and bigquery can serve repeated queries from its result cache
         sql = (
             f'SELECT coin, price, cap, date '
             f'FROM `{table}` '
             f'WHERE coin '
-            f'IN ({coins_sql}) '
+            f'IN UNNEST(@coins) '
+            f'AND (cap IS NULL OR cap != 0) '
             f'ORDER BY coin, date ASC'
         )
+        job_config = bigquery.QueryJobConfig(
+            query_parameters=[bigquery.ArrayQueryParameter('coins', 'STRING', coins)],
+            use_query_cache=True
+        )
 
         try:
-            # can set json location as env
-            client = bigquery.Client.from_service_account_json(dataset_loc)
-            q = client.query(sql)
+            q = get_client().query(sql, job_config=job_config)
             stdout(f'querying API...')
-            q.result()  # this is where API is queried
+            rows = q.result(page_size=page_size)  # this is where API is queried
         except FileNotFoundError:
             raise ErrorCallback(2)
         except Exception:
             raise ErrorCallback(3)
 
-        results = list(q)
-        if len(results) == 0:
+        # rows are streamed page by page straight into the csv
+        if rows.total_rows == 0:
             raise ErrorCallback(7)
 
-        stdout(f'results received...')
+        stdout(f'query done, streaming results...')
 
-        csv_success = create_csv(results)
+        try:
+            csv_success = create_csv(rows)
+        except (GoogleAPIError, RequestException):
+            raise ErrorCallback(3)
         if not csv_success:
             raise ErrorCallback(4)
 
@@ -222,7 +263,8 @@ if __name__ == '__main__':
             f'Location: {q.location}\n'
             f'Project: {q.project}\n'
             f'Query: {q.query}\n'
-            f'Results: {len(results)}\n'
+            f'Coins: {coins}\n'
+            f'Results: {rows.total_rows}\n'
             f'Bytes Processed: {q.total_bytes_processed}\n'
             f'Bytes Billed: {q.total_bytes_billed}\n'
             f'ETag: {q.etag}\n'
@@ -231,7 +273,7 @@ if __name__ == '__main__':
         stdout(f'receipt.txt created...')
 
         # can use unique per task or generic
-        create_deterministic(str(q.query))
+        create_deterministic(f'{q.query} {coins}')
         stdout(f'deterministic file created...')
 
     except ErrorCallback as e_callback:
@@ -246,12 +288,17 @@ if __name__ == '__main__':
     # cant combo deterministic with callback error or replace
     # must always upload to IPFS on error?
 
-    if error:
-        deterministic = create_deterministic('error')
-        stdout(f'deterministic error file created...')
-
-        # error file for easier filtering
-        create_error_file(error)
-        stdout(f'error file created...')
+    try:
+        if error:
+            deterministic = create_deterministic('error')
+            stdout(f'deterministic error file created...')
+
+            # error file for easier filtering
+            create_error_file(error)
+            stdout(f'error file created...')
+    finally:
+        # only written once so the worker never reads a stale or partial file
+        create_computed_json(computed)
+        stdout(f'computed.json created...')
 
     stdout(f'Done: {str(time())}')